@@ -0,0 +1,444 @@
+import streamlit as st
+from streamlit_webrtc import VideoProcessorBase
+import av
+import cv2
+import numpy as np
+import simplejpeg
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests_unixsocket
+import time
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from reportlab.lib.utils import ImageReader
+import io
+import collections
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Frames are small (640x480 -> 320x320); OpenCV's thread pool costs more than
+# it saves here and competes with the WebRTC and inference threads. The SIMD
+# code paths stay on regardless of how the host environment configured OpenCV.
+cv2.setUseOptimized(True)
+cv2.setNumThreads(1)
+
+logger = logging.getLogger(__name__)
+
+# --- Detection Log ---
+# Bounded store for frames with potholes, kept as parallel arrays. Frames are
+# downscaled to the width they are shown at in the report (keeping the camera's
+# aspect ratio) and held JPEG-encoded, and slots are overwritten in ring order,
+# so memory stays fixed.
+DETECTION_LOG_SIZE = 64
+REPORT_IMAGE_WIDTH = 400
+
+class DetectionLog:
+    def __init__(self, capacity=DETECTION_LOG_SIZE):
+        self.capacity = capacity
+        self.frames = [None] * capacity
+        self.timestamps = np.zeros(capacity, dtype="datetime64[ms]")
+        self.detections = [None] * capacity
+        self.order = collections.deque(maxlen=capacity)
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        # Reused resize target, so logging a frame doesn't allocate a new one;
+        # only reallocated when the camera resolution changes
+        self._scratch = None
+
+    def append(self, frame, detections):
+        with self._lock:
+            height, width = frame.shape[:2]
+            if width > REPORT_IMAGE_WIDTH:
+                shape = (round(height * REPORT_IMAGE_WIDTH / width), REPORT_IMAGE_WIDTH, 3)
+                if self._scratch is None or self._scratch.shape != shape:
+                    self._scratch = np.empty(shape, dtype=np.uint8)
+                cv2.resize(frame, (shape[1], shape[0]), dst=self._scratch, interpolation=cv2.INTER_AREA)
+                frame = self._scratch
+            jpg = simplejpeg.encode_jpeg(frame, quality=80, colorspace="BGR")
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.capacity
+            self.frames[slot] = jpg
+            self.timestamps[slot] = np.datetime64(time.time_ns() // 1_000_000, "ms")
+            self.detections[slot] = detections
+            self.order.append(slot)
+
+    def entries(self):
+        with self._lock:
+            return [(self.frames[i], self.detections[i], self.timestamps[i]) for i in self.order]
+
+    def last(self):
+        with self._lock:
+            i = self.order[-1]
+            return self.frames[i], self.detections[i]
+
+    def __len__(self):
+        return len(self.order)
+
+# --- Pipeline Status ---
+# Written by the inference threads, read by the script on each rerun. Streamlit
+# elements can't be emitted from the video threads, so they only record here.
+class PipelineStatus:
+    def __init__(self):
+        self.frame_count = 0
+        self.latency_ms = 0.0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def count_frame(self):
+        with self._lock:
+            self.frame_count += 1
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+# --- Session State ---
+def init_state():
+    if "processed_frames" not in st.session_state:
+        st.session_state.processed_frames = DetectionLog()
+    if "pipeline_status" not in st.session_state:
+        st.session_state.pipeline_status = PipelineStatus()
+    if "api_status" not in st.session_state:
+        st.session_state.api_status = "Unchecked"
+
+# --- Shared HTTP Session ---
+# One keep-alive session for the whole app, so the TLS handshake with the API
+# is paid once instead of on every frame. A single quick retry covers the
+# connectivity check; frame uploads are POSTs and are never re-sent, since the
+# server may store a geotagged detection for each one.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    retry = Retry(total=1, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.mount("http+unix://", requests_unixsocket.UnixAdapter())
+    return session
+
+# --- API Connectivity Check ---
+def check_api_connection(session, api_url):
+    try:
+        response = session.get(f"{api_url}/", timeout=5)
+        if response.status_code == 200:
+            return "✅ Connected"
+        return f"⚠️ Error {response.status_code}"
+    except Exception as e:
+        return f"❌ Failed: {e}"
+
+# --- Frame Processing Functions ---
+# The server's model takes 320x320 input; at that size higher JPEG quality
+# doesn't change detections, it only makes each upload bigger.
+MODEL_INPUT_SIZE = 320
+UPLOAD_JPEG_QUALITY = 60
+
+# Returns None when the API call fails, so callers can tell a failed upload
+# apart from a frame that genuinely has no potholes.
+def fetch_detections(frame, session, url, location, status):
+    if frame.shape[:2] == (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE):
+        resized = frame
+    else:
+        resized = cv2.resize(frame, (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), interpolation=cv2.INTER_AREA)
+    img_bytes = simplejpeg.encode_jpeg(resized, quality=UPLOAD_JPEG_QUALITY, colorspace="BGR", fastdct=True)
+
+    files = {"file": ("image.jpg", img_bytes, "image/jpeg")}
+
+    try:
+        start_time = time.time()
+        response = session.post(url, files=files, data=location, timeout=10)
+        elapsed = time.time() - start_time
+        status.update(latency_ms=elapsed * 1000)
+
+        if response.status_code == 200:
+            result = response.json()
+            status.update(last_error=None)
+            return result.get("detections", [])
+        error = f"Server returned {response.status_code}"
+    except Exception as e:
+        error = f"API error: {e}"
+    logger.warning(error)
+    status.update(last_error=error)
+    return None
+
+CONFIDENCE_THRESHOLD = 0.5
+
+# The camera resolution doesn't change mid-stream, so the model-to-frame box
+# scale is built once per frame shape rather than on every frame.
+@functools.lru_cache(maxsize=8)
+def box_scale(height, width):
+    sx, sy = width / MODEL_INPUT_SIZE, height / MODEL_INPUT_SIZE
+    scale = np.array([sx, sy, sx, sy], dtype=np.float32)
+    scale.setflags(write=False)
+    return scale
+
+# Box and label styling
+BOX_COLOR = (0, 255, 0)
+BOX_THICKNESS = 2
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_SCALE = 0.5
+LABEL_COLOR = (255, 255, 255)
+LABEL_THICKNESS = 2
+
+# Labels repeat constantly ("pothole 0.87"), so each distinct string is
+# rasterized once and then copied onto frames through its glyph mask.
+@functools.lru_cache(maxsize=512)
+def label_sprite(text):
+    (w, h), baseline = cv2.getTextSize(text, LABEL_FONT, LABEL_SCALE, LABEL_THICKNESS)
+    pad = LABEL_THICKNESS
+    img = np.zeros((h + baseline + 2 * pad, w + 2 * pad, 3), dtype=np.uint8)
+    cv2.putText(img, text, (pad, pad + h), LABEL_FONT, LABEL_SCALE, LABEL_COLOR, LABEL_THICKNESS)
+    mask = img.any(axis=2, keepdims=True)
+    img.setflags(write=False)
+    mask.setflags(write=False)
+    return img, mask, pad + h, pad
+
+# Same placement as cv2.putText with (x, y) as the text origin, clipped to the frame
+def draw_label(frame, text, x, y):
+    img, mask, ascent, pad = label_sprite(text)
+    top, left = y - ascent, x - pad
+    y0, x0 = max(top, 0), max(left, 0)
+    y1 = min(top + img.shape[0], frame.shape[0])
+    x1 = min(left + img.shape[1], frame.shape[1])
+    if y0 >= y1 or x0 >= x1:
+        return
+    src = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+    np.copyto(frame[y0:y1, x0:x1], img[src], where=mask[src])
+
+def draw_detections(frame, detections):
+    if not detections:
+        return False
+
+    # Filter and scale every box in NumPy instead of per-detection Python math
+    scale = box_scale(*frame.shape[:2])
+    arr = np.array([[d["x_min"], d["y_min"], d["x_max"], d["y_max"], d["confidence"]] for d in detections], dtype=np.float32)
+    keep = np.flatnonzero(arr[:, 4] > CONFIDENCE_THRESHOLD)
+    if keep.size == 0:
+        return False
+    boxes = (arr[keep, :4] * scale).astype(np.int32)
+
+    for i, (x1, y1, x2, y2) in zip(keep.tolist(), boxes.tolist()):
+        det = detections[i]
+        cv2.rectangle(frame, (x1, y1), (x2, y2), BOX_COLOR, BOX_THICKNESS)
+        draw_label(frame, f"{det['class_name']} {det['confidence']:.2f}", x1, y1 - 10)
+
+    return True
+
+# Mean absolute difference (0-255 scale) between 16x16 luma thumbnails below
+# which a frame counts as unchanged and reuses the previous detections.
+STATIC_FRAME_THRESHOLD = 2.0
+
+# Takes the thumbnail straight from the Y plane of the decoded YUV420 frame,
+# so change detection never needs the BGR conversion.
+def luma_thumbnail(frame):
+    if frame.format.name in ("yuv420p", "yuvj420p"):
+        plane = frame.planes[0]
+        luma = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+    else:
+        luma = frame.to_ndarray(format="gray")
+    return cv2.resize(luma, (16, 16), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+# Recent API results keyed by a 64-bit difference hash of the frame, so a scene
+# seen moments ago (e.g. the camera swinging back) doesn't need another call.
+DETECTION_CACHE_SIZE = 256
+DETECTION_CACHE_TTL = 2.0
+# Hashes this many bits or fewer apart count as the same scene. The hash only
+# looks at brightness gradients, so it also catches frames that the pixel
+# difference check misses because auto-exposure shifted the whole image. The
+# coarse hash barely moves on a steady road view, so the match only holds for
+# DETECTION_CACHE_TTL after the last upload.
+HASH_DISTANCE_THRESHOLD = 4
+
+def frame_hash(thumb):
+    small = cv2.resize(thumb, (9, 8), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+def hash_distance(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).bit_count()
+
+# --- WebRTC Video Processing ---
+MEDIA_STREAM_CONSTRAINTS = {"video": True, "audio": False}
+MAX_INFLIGHT = 4
+# Weight of the newest sample in the smoothed API round-trip time
+RTT_SMOOTHING = 0.2
+
+# Inference runs off the WebRTC callback. The dispatcher thread only ever takes
+# the newest frame and keeps up to MAX_INFLIGHT API calls running in parallel;
+# results that come back after a newer frame has been shown are dropped.
+# Uploads are paced to the server's measured throughput (smoothed RTT spread
+# over the in-flight slots); frames in between reuse the last detections.
+class VideoProcessor(VideoProcessorBase):
+    def __init__(self, session, detection_log, status):
+        self._session = session
+        self._detection_log = detection_log
+        self._status = status
+        self._upload_url = None
+        self._location = None
+        self._latest_in = collections.deque(maxlen=1)
+        self._latest_out = None
+        self._frame_ready = threading.Event()
+        self._stopped = threading.Event()
+        self._inflight = threading.Semaphore(MAX_INFLIGHT)
+        self._pool = ThreadPoolExecutor(max_workers=MAX_INFLIGHT)
+        self._result_lock = threading.Lock()
+        self._next_id = 0
+        self._shown_id = 0
+        self._result_id = 0
+        # (thumbnail, hash) of the last uploaded frame, replaced as one value so
+        # the result callbacks can clear it without racing the dispatcher
+        self._sent = None
+        self._last_detections = []
+        self._ema_rtt = 0.1
+        self._last_sent = 0.0
+        self._cache = collections.OrderedDict()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    # Called from the script on every rerun so edits to the URL or location
+    # reach a stream that is already running.
+    def configure(self, api_url, latitude, longitude):
+        self._upload_url = f"{api_url}/process_frame/"
+        self._location = {"latitude": latitude, "longitude": longitude}
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._frame_ready.wait(timeout=0.5):
+                continue
+            self._frame_ready.clear()
+            try:
+                frame = self._latest_in.pop()
+            except IndexError:
+                continue
+            self._next_id += 1
+            self._status.count_frame()
+
+            # Unchanged scene, recently seen scene, or too soon for the server
+            # to keep up (including every in-flight slot being busy): draw known
+            # boxes instead of calling the API, so the video never waits on it
+            now = time.monotonic()
+            thumb = luma_thumbnail(frame)
+            key = frame_hash(thumb)
+            img = frame.to_ndarray(format="bgr24")
+            sent = self._sent
+            unchanged = sent is not None and (
+                np.abs(thumb - sent[0]).mean() < STATIC_FRAME_THRESHOLD
+                or (
+                    now - self._last_sent < DETECTION_CACHE_TTL
+                    and hash_distance(key, sent[1]) <= HASH_DISTANCE_THRESHOLD
+                )
+            )
+            cached = self._cached_detections(key, now)
+            too_soon = now - self._last_sent < self._ema_rtt / MAX_INFLIGHT
+            if unchanged or cached is not None or too_soon or not self._inflight.acquire(blocking=False):
+                draw_detections(img, cached if cached is not None else self._last_detections)
+                self._show(self._next_id, img)
+                continue
+            self._sent = (thumb, key)
+            self._last_sent = now
+
+            try:
+                future = self._pool.submit(self._process, img, self._upload_url, self._location)
+            except RuntimeError:
+                # on_ended shut the pool down while this frame was being prepared
+                self._inflight.release()
+                break
+            future.add_done_callback(functools.partial(self._on_result, self._next_id, now, key))
+
+    def _process(self, frame, url, location):
+        detections = fetch_detections(frame, self._session, url, location, self._status)
+        if detections is None:
+            return frame, None
+        if draw_detections(frame, detections):
+            self._detection_log.append(frame, detections)
+        return frame, detections
+
+    def _cached_detections(self, key, now):
+        with self._result_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            stored_at, detections = entry
+            if now - stored_at > DETECTION_CACHE_TTL:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return detections
+
+    def _on_result(self, frame_id, sent_at, key, future):
+        self._inflight.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Frame processing failed", exc_info=error)
+            self._status.update(last_error=f"Processing error: {error!r}")
+            # As with a failed upload, let the next frame go out again
+            self._sent = None
+            return
+        frame, detections = future.result()
+        if detections is None:
+            # Failed upload: keep the last real result on screen and let the
+            # next frame go out instead of being matched against this one
+            self._sent = None
+            with self._result_lock:
+                last_detections = self._last_detections
+            draw_detections(frame, last_detections)
+            self._show(frame_id, frame)
+            return
+        with self._result_lock:
+            self._cache[key] = (sent_at, detections)
+            self._cache.move_to_end(key)
+            if len(self._cache) > DETECTION_CACHE_SIZE:
+                self._cache.popitem(last=False)
+            rtt = time.monotonic() - sent_at
+            self._ema_rtt = (1 - RTT_SMOOTHING) * self._ema_rtt + RTT_SMOOTHING * rtt
+            if frame_id > self._result_id:
+                self._result_id = frame_id
+                self._last_detections = detections
+        self._show(frame_id, frame)
+
+    def _show(self, frame_id, frame):
+        with self._result_lock:
+            if frame_id < self._shown_id:
+                return
+            self._shown_id = frame_id
+            self._latest_out = frame
+
+    def recv(self, frame):
+        # Frames stay YUV420 until the dispatcher picks them up; ones that get
+        # replaced in the slot first are never converted to BGR at all.
+        self._latest_in.append(frame)
+        self._frame_ready.set()
+        if self._latest_out is None:
+            return frame
+        return av.VideoFrame.from_ndarray(self._latest_out, format="bgr24")
+
+    def on_ended(self):
+        self._stopped.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+# --- PDF Report ---
+def build_pdf(entries):
+    pdf_buffer = io.BytesIO()
+    c = canvas.Canvas(pdf_buffer, pagesize=letter)
+    c.setFont("Helvetica", 12)
+    c.drawString(100, 750, "Pothole Detection Report")
+    c.drawString(100, 730, f"Date: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    y = 700
+
+    for i, (frame, detections, timestamp) in enumerate(entries):
+        image = ImageReader(io.BytesIO(frame))
+        width, height = image.getSize()
+        if y - height < 50:
+            c.showPage()
+            y = 750
+        seen_at = time.strftime("%H:%M:%S", time.localtime(timestamp.astype(np.int64) / 1000))
+        c.drawString(100, y, f"Frame {i+1} ({seen_at}): {len(detections)} potholes detected")
+        c.drawImage(image, 100, y - 10 - height, width=width, height=height)
+        y -= height + 30
+
+    c.save()
+    return pdf_buffer.getvalue()